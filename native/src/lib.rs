@@ -0,0 +1,275 @@
+//! Native directory scanner for directory_sync.
+//!
+//! Walks a tree on a pool of threads and collects the same per-file metadata
+//! the Python walker does, without holding the GIL. The walk follows the
+//! Python walker rule for rule: the root is listed even if it is a symlink,
+//! only real directories are descended into, symlinked directories are
+//! skipped, symlinked files are followed, and anything that is not a
+//! regular file (or cannot be stat'ed) is left out.
+//!
+//! Files are handed to a Python callback one directory at a time, as the
+//! walk goes, so the caller can start hashing before the scan is done.
+
+use std::cmp::Reverse;
+use std::collections::BinaryHeap;
+use std::ffi::{c_char, OsStr, OsString};
+use std::fs;
+use std::os::unix::ffi::{OsStrExt, OsStringExt};
+use std::os::unix::fs::{DirEntryExt, MetadataExt};
+use std::panic;
+use std::path::PathBuf;
+use std::ptr;
+use std::sync::{Condvar, Mutex};
+use std::thread;
+
+use pyo3_ffi::*;
+
+/// (relative path, size, mtime_ns, inode, device)
+type FileRecord = (OsString, u64, i64, u64, u64);
+
+/// A directory waiting to be listed: (inode, full path, relative path).
+type PendingDirectory = Reverse<(u64, PathBuf, OsString)>;
+
+struct WalkState {
+    directories: BinaryHeap<PendingDirectory>,
+    // Directories that are queued or currently being listed.
+    pending: usize,
+    // Set once the callback fails; the workers then stop.
+    stopped: bool,
+}
+
+/// Lists one directory, returning its files and its subdirectories.
+fn scan_directory(directory: &PathBuf, relative_directory: &OsStr) -> (Vec<FileRecord>, Vec<PendingDirectory>) {
+    let mut records = Vec::new();
+    let mut subdirectories = Vec::new();
+    let entries = match fs::read_dir(directory) {
+        Ok(entries) => entries,
+        Err(_) => return (records, subdirectories),
+    };
+    for entry in entries.filter_map(Result::ok) {
+        let mut relative_path = relative_directory.to_os_string();
+        if !relative_path.is_empty() {
+            relative_path.push("/");
+        }
+        relative_path.push(entry.file_name());
+        let file_type = match entry.file_type() {
+            Ok(file_type) => file_type,
+            Err(_) => continue,
+        };
+        if file_type.is_dir() {
+            subdirectories.push(Reverse((entry.ino(), entry.path(), relative_path)));
+            continue;
+        }
+        // Symlinked directories are skipped; symlinked files are followed.
+        // Pipes, sockets and devices are skipped too.
+        match fs::metadata(entry.path()) {
+            Ok(meta) if meta.is_file() => {
+                let mtime_ns = meta.mtime() * 1_000_000_000 + meta.mtime_nsec();
+                records.push((relative_path, meta.len(), mtime_ns, meta.ino(), meta.dev()));
+            }
+            _ => {}
+        }
+    }
+    (records, subdirectories)
+}
+
+/// Walks the tree under root with threads workers, listing pending
+/// directories in inode order and passing each directory's files to emit.
+/// The walk stops early if emit returns false.
+fn walk(root: PathBuf, threads: usize, emit: &(dyn Fn(Vec<FileRecord>) -> bool + Sync)) {
+    let mut directories = BinaryHeap::new();
+    directories.push(Reverse((0, root, OsString::new())));
+    let state = Mutex::new(WalkState { directories, pending: 1, stopped: false });
+    let ready = Condvar::new();
+
+    thread::scope(|scope| {
+        for _ in 0..threads {
+            scope.spawn(|| loop {
+                let Reverse((_, directory, relative_directory)) = {
+                    let mut guard = state.lock().unwrap();
+                    loop {
+                        if guard.stopped || guard.pending == 0 {
+                            return;
+                        }
+                        if let Some(next) = guard.directories.pop() {
+                            break next;
+                        }
+                        guard = ready.wait(guard).unwrap();
+                    }
+                };
+                let (records, subdirectories) = scan_directory(&directory, &relative_directory);
+                let keep_going = records.is_empty() || emit(records);
+                let mut guard = state.lock().unwrap();
+                guard.pending += subdirectories.len();
+                guard.pending -= 1;
+                guard.directories.extend(subdirectories);
+                guard.stopped |= !keep_going;
+                ready.notify_all();
+            });
+        }
+    });
+}
+
+/// A Python object pointer that is only dereferenced with the GIL held.
+struct GilBound(*mut PyObject);
+
+unsafe impl Send for GilBound {}
+unsafe impl Sync for GilBound {}
+
+/// The exception raised by the callback, as returned by PyErr_Fetch.
+struct FetchedError(*mut PyObject, *mut PyObject, *mut PyObject);
+
+unsafe impl Send for FetchedError {}
+
+/// Converts the records to a list of (str, int, int, int, int) tuples.
+/// Must be called with the GIL held.
+unsafe fn records_to_list(records: Vec<FileRecord>) -> *mut PyObject {
+    let list = PyList_New(0);
+    if list.is_null() {
+        return ptr::null_mut();
+    }
+    for (relative_path, size, mtime_ns, ino, dev) in records {
+        let bytes = relative_path.as_bytes();
+        let name = PyUnicode_DecodeFSDefaultAndSize(bytes.as_ptr().cast::<c_char>(), bytes.len() as Py_ssize_t);
+        if name.is_null() {
+            Py_DECREF(list);
+            return ptr::null_mut();
+        }
+        let record = Py_BuildValue(c"(NKLKK)".as_ptr(), name, size, mtime_ns, ino, dev);
+        if record.is_null() || PyList_Append(list, record) != 0 {
+            Py_XDECREF(record);
+            Py_DECREF(list);
+            return ptr::null_mut();
+        }
+        Py_DECREF(record);
+    }
+    list
+}
+
+/// Calls callback(files) from a scanner thread. On failure the exception
+/// is moved into error and false is returned.
+unsafe fn call_back(callback: &GilBound, records: Vec<FileRecord>, error: &Mutex<Option<FetchedError>>) -> bool {
+    let gil = PyGILState_Ensure();
+    let files = records_to_list(records);
+    let result = if files.is_null() {
+        ptr::null_mut()
+    } else {
+        let result = PyObject_CallFunctionObjArgs(callback.0, files, ptr::null_mut::<PyObject>());
+        Py_DECREF(files);
+        result
+    };
+    let ok = !result.is_null();
+    if ok {
+        Py_DECREF(result);
+    } else {
+        let mut fetched = FetchedError(ptr::null_mut(), ptr::null_mut(), ptr::null_mut());
+        PyErr_Fetch(&mut fetched.0, &mut fetched.1, &mut fetched.2);
+        let mut error = error.lock().unwrap();
+        match error.take() {
+            // Another thread failed first; keep its exception.
+            Some(first) => {
+                Py_XDECREF(fetched.0);
+                Py_XDECREF(fetched.1);
+                Py_XDECREF(fetched.2);
+                *error = Some(first);
+            }
+            None => *error = Some(fetched),
+        }
+    }
+    PyGILState_Release(gil);
+    ok
+}
+
+/// Converts a str, bytes or os.PathLike argument to a path.
+unsafe fn path_argument(obj: *mut PyObject) -> Option<PathBuf> {
+    let mut bytes: *mut PyObject = ptr::null_mut();
+    if PyUnicode_FSConverter(obj, (&raw mut bytes).cast()) == 0 {
+        return None;
+    }
+    let mut data: *mut c_char = ptr::null_mut();
+    let mut length: Py_ssize_t = 0;
+    let path = if PyBytes_AsStringAndSize(bytes, &mut data, &mut length) == 0 {
+        let raw = std::slice::from_raw_parts(data.cast::<u8>(), length as usize);
+        Some(PathBuf::from(OsString::from_vec(raw.to_vec())))
+    } else {
+        None
+    };
+    Py_DECREF(bytes);
+    path
+}
+
+/// scan_tree(path, threads, callback)
+unsafe extern "C" fn scan_tree(_module: *mut PyObject, args: *mut PyObject) -> *mut PyObject {
+    if PyTuple_Size(args) != 3 {
+        PyErr_SetString(PyExc_TypeError, c"scan_tree() takes exactly 3 arguments".as_ptr());
+        return ptr::null_mut();
+    }
+    let root = match path_argument(PyTuple_GetItem(args, 0)) {
+        Some(root) => root,
+        None => return ptr::null_mut(),
+    };
+    let threads = PyLong_AsSsize_t(PyTuple_GetItem(args, 1));
+    if threads == -1 && !PyErr_Occurred().is_null() {
+        return ptr::null_mut();
+    }
+    if threads < 1 {
+        PyErr_SetString(PyExc_ValueError, c"threads must be at least 1".as_ptr());
+        return ptr::null_mut();
+    }
+    // Borrowed from args, which outlives the call.
+    let callback = GilBound(PyTuple_GetItem(args, 2));
+    if PyCallable_Check(callback.0) == 0 {
+        PyErr_SetString(PyExc_TypeError, c"callback must be callable".as_ptr());
+        return ptr::null_mut();
+    }
+
+    let error = Mutex::new(None);
+    let thread_state = PyEval_SaveThread();
+    let result = panic::catch_unwind(|| {
+        walk(root, threads as usize, &|records| unsafe { call_back(&callback, records, &error) })
+    });
+    PyEval_RestoreThread(thread_state);
+    if result.is_err() {
+        PyErr_SetString(PyExc_RuntimeError, c"directory scan failed".as_ptr());
+        return ptr::null_mut();
+    }
+    if let Some(FetchedError(kind, value, traceback)) = error.into_inner().unwrap() {
+        PyErr_Restore(kind, value, traceback);
+        return ptr::null_mut();
+    }
+    Py_IncRef(Py_None());
+    Py_None()
+}
+
+static mut METHODS: [PyMethodDef; 2] = [
+    PyMethodDef {
+        ml_name: c"scan_tree".as_ptr(),
+        ml_meth: PyMethodDefPointer { PyCFunction: scan_tree },
+        ml_flags: METH_VARARGS,
+        ml_doc: c"scan_tree(path, threads, callback)\n--\n\n\
+Scans the tree under path on threads threads, calling callback with a list of\n\
+(relative path, size, mtime_ns, inode, device) records for each directory\n\
+that has files in it. The callback runs on the scanner threads; if it\n\
+raises, the scan stops and the exception is raised from scan_tree."
+            .as_ptr(),
+    },
+    PyMethodDef::zeroed(),
+];
+
+static mut MODULE_DEF: PyModuleDef = PyModuleDef {
+    m_base: PyModuleDef_HEAD_INIT,
+    m_name: c"directory_sync_native".as_ptr(),
+    m_doc: c"Native directory scanner for directory_sync.".as_ptr(),
+    m_size: 0,
+    m_methods: (&raw mut METHODS).cast(),
+    m_slots: ptr::null_mut(),
+    m_traverse: None,
+    m_clear: None,
+    m_free: None,
+};
+
+#[allow(non_snake_case)]
+#[no_mangle]
+pub unsafe extern "C" fn PyInit_directory_sync_native() -> *mut PyObject {
+    PyModule_Create(&raw mut MODULE_DEF)
+}
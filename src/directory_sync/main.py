@@ -1,56 +1,464 @@
 import argparse
+import errno
 import os
 import hashlib
+import json
+import mmap
+import multiprocessing
+import queue
 import shutil
-from collections import defaultdict
+import stat
+import threading
 import concurrent.futures
+from itertools import chain
+import xxhash
 from tqdm import tqdm
 
-def get_file_info(path, compare_mode):
-    """Gets the size and checksum of a file."""
-    info = {}
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    from directory_sync_native import scan_tree
+except ImportError:
+    scan_tree = None
+
+HASH_ALGORITHMS = ['xxh3', 'md5', 'sha256', 'blake3']
+
+# Number of files sent to a hashing process per job.
+HASH_BATCH_SIZE = 64
+
+# Buffer size for chunked reads and copies: big enough to amortize the syscall,
+# small enough to stay in L2 cache.
+CHUNK_SIZE = 128 * 1024
+
+# Bytes of each file in a hashing batch to request readahead for before hashing starts.
+PREFETCH_SIZE = 1024 * 1024
+
+# Files up to this size are hashed with a single read instead of a mapping.
+SMALL_FILE_SIZE = 64 * 1024
+
+# Files above this size are read on a background thread while the previous block is hashed.
+OVERLAPPED_READ_SIZE = 4 * 1024 * 1024
+OVERLAPPED_BLOCK_SIZE = 1024 * 1024
+
+# Threads each BLAKE3 hasher may use; -1 is blake3.blake3.AUTO. Hashing pool
+# processes lower it so that the pool as a whole stays at about one thread per core.
+_blake3_threads = -1
+
+def new_hasher(hash_algorithm):
+    """Creates a hasher for the given algorithm."""
+    if hash_algorithm == 'blake3':
+        if blake3 is None:
+            raise ValueError("The 'blake3' package is required for --hash blake3.")
+        return blake3.blake3(max_threads=_blake3_threads)
+    if hash_algorithm == 'xxh3':
+        # Change detection doesn't need a cryptographic hash.
+        return xxhash.xxh3_128()
+    # OpenSSL picks up SHA-NI for sha256 when the CPU supports it.
+    return hashlib.new(hash_algorithm)
+
+def _hash_overlapped(fd, hasher):
+    """Hashes a file while a reader thread fills the next of two buffers."""
+    free = queue.Queue()
+    filled = queue.Queue()
+    for _ in range(2):
+        free.put(bytearray(OVERLAPPED_BLOCK_SIZE))
+
+    def read():
+        offset = 0
+        while True:
+            buf = free.get()
+            try:
+                n = os.preadv(fd, [buf], offset)
+            except OSError as e:
+                filled.put((e, 0))
+                return
+            filled.put((buf, n))
+            if n == 0:
+                return
+            offset += n
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    while True:
+        buf, n = filled.get()
+        if isinstance(buf, OSError):
+            raise buf
+        if n == 0:
+            break
+        hasher.update(memoryview(buf)[:n])
+        free.put(buf)
+    reader.join()
+
+def hash_file(path, hasher):
+    """Feeds the contents of a file into the hasher, picking a read strategy by size."""
+    # Without O_BINARY, Windows opens in text mode: CRLF is translated and 0x1A ends the read.
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            # Empty files (and procfs-style files, which report size 0) cannot be mapped.
+            buf = bytearray(CHUNK_SIZE)
+            view = memoryview(buf)
+            with os.fdopen(os.dup(fd), 'rb', buffering=0) as f:
+                n = f.readinto(buf)
+                while n:
+                    hasher.update(view[:n])
+                    n = f.readinto(buf)
+            return
+        if size <= SMALL_FILE_SIZE:
+            # Setting up and tearing down a mapping costs more than it saves here.
+            hasher.update(os.read(fd, size))
+            return
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if size > OVERLAPPED_READ_SIZE and hasattr(os, 'preadv'):
+            # Page faults on a mapping stall the hash; reading ahead keeps both busy.
+            _hash_overlapped(fd, hasher)
+            return
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_WILLNEED)
+            hasher.update(mm)
+        finally:
+            mm.close()
+    finally:
+        os.close(fd)
+
+# Files above this size are hashed with BLAKE3's multithreaded tree hash, when installed,
+# whatever --hash says: a single MD5 or xxh3 stream can't be split across cores.
+TREE_HASH_SIZE = 64 * 1024 * 1024
+
+# Extended attribute holding "<mtime_ns>:<size>:<algorithm>:<digest>" from the last hash.
+CHECKSUM_XATTR = 'user.directory_sync.checksum'
+
+def _read_cached_checksum(path, hash_algorithm, size, mtime_ns):
+    """Returns the checksum cached on the file if it is still valid, else None."""
+    if not hasattr(os, 'getxattr'):
+        return None
     try:
-        info['size'] = os.path.getsize(path)
-        if compare_mode == 'checksum':
-            hasher = hashlib.md5()
-            with open(path, 'rb') as f:
-                # Increased buffer size to 1MB
-                buf = f.read(1024 * 1024)
-                while len(buf) > 0:
-                    hasher.update(buf)
-                    buf = f.read(1024 * 1024)
-            info['checksum'] = hasher.hexdigest()
-    except (IOError, OSError):
+        value = os.getxattr(path, CHECKSUM_XATTR).decode('ascii')
+    except (OSError, UnicodeDecodeError):
         return None
-    return info
+    if value.rpartition(':')[0] != f"{mtime_ns}:{size}:{hash_algorithm}":
+        return None
+    return value.rpartition(':')[2]
 
-def get_directory_state(path, compare_mode, max_workers=None):
-    """Recursively gets the state of a directory using parallel processing."""
-    state = {}
-    files_to_process = []
-    
-    for root, _, files in os.walk(path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(file_path, path)
-            files_to_process.append((file_path, relative_path))
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_path = {
-            executor.submit(get_file_info, fp, compare_mode): rp 
-            for fp, rp in files_to_process
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_path):
-            relative_path = future_to_path[future]
+def _write_cached_checksum(path, hash_algorithm, size, mtime_ns, checksum):
+    """Caches the checksum on the file; silently skipped where xattrs are unsupported."""
+    if not hasattr(os, 'setxattr'):
+        return
+    try:
+        os.setxattr(path, CHECKSUM_XATTR, f"{mtime_ns}:{size}:{hash_algorithm}:{checksum}".encode('ascii'))
+    except OSError:
+        pass
+
+def _clear_cached_checksum(path):
+    """Removes the checksum cached on the file, if there is one."""
+    if not hasattr(os, 'removexattr'):
+        return
+    try:
+        os.removexattr(path, CHECKSUM_XATTR)
+    except OSError:
+        pass
+
+def _effective_algorithm(hash_algorithm, size):
+    """Returns the algorithm a file of this size is actually hashed with."""
+    if size > TREE_HASH_SIZE and blake3 is not None:
+        return 'blake3'
+    return hash_algorithm
+
+def get_checksum(path, hash_algorithm, size, mtime_ns, use_cache=True, update_cache=True):
+    """Gets the checksum of a file, reusing the cached one if size and mtime still match.
+
+    With update_cache off, a freshly computed checksum is not written back.
+
+    The result is prefixed with the algorithm actually used, so checksums
+    from different algorithms never compare equal.
+    """
+    hash_algorithm = _effective_algorithm(hash_algorithm, size)
+    checksum = None
+    if use_cache:
+        checksum = _read_cached_checksum(path, hash_algorithm, size, mtime_ns)
+    if checksum is None:
+        hasher = new_hasher(hash_algorithm)
+        if hash_algorithm == 'blake3' and size > SMALL_FILE_SIZE:
+            # Maps the file and hashes its chunks in parallel.
+            hasher.update_mmap(path)
+        else:
+            hash_file(path, hasher)
+        checksum = hasher.hexdigest()
+        if use_cache and update_cache:
+            _write_cached_checksum(path, hash_algorithm, size, mtime_ns, checksum)
+    return f"{hash_algorithm}:{checksum}"
+
+def _state_cache_path(root):
+    """Returns where the checksums of the tree at root are kept between runs.
+
+    The file is keyed on the real path and device of root, so a different
+    filesystem mounted at the same place gets its own cache.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    real_root = os.path.realpath(root)
+    key = hashlib.sha256(f"{real_root}:{os.stat(real_root).st_dev}".encode('utf-8', 'surrogateescape'))
+    return os.path.join(cache_home, 'directory_sync', f"{key.hexdigest()[:32]}.json")
+
+def _is_cache_entry(relative_path, entry):
+    """Checks that a loaded cache entry has the (mtime_ns, size, checksum) shape."""
+    return (isinstance(relative_path, str) and isinstance(entry, list) and len(entry) == 3
+            and type(entry[0]) is int and type(entry[1]) is int and isinstance(entry[2], str))
+
+def load_state_cache(root):
+    """Loads the {relative path: (mtime_ns, size, checksum)} cache for a tree.
+
+    The cache is JSON rather than pickle, as anyone who can write to the
+    cache directory could otherwise run code here. A missing or unreadable
+    cache is treated as empty, and malformed entries are dropped.
+    """
+    try:
+        with open(_state_cache_path(root), 'rb') as f:
+            cache = json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {
+        relative_path: tuple(entry)
+        for relative_path, entry in cache.items() if _is_cache_entry(relative_path, entry)
+    }
+
+def save_state_cache(root, state, exclude=frozenset()):
+    """Writes the checksums in a directory state to the tree's cache, atomically.
+
+    Paths in exclude are left out of the cache.
+    """
+    cache = {
+        relative_path: (info['mtime_ns'], info['size'], info['checksum'])
+        for relative_path, info in state.items() if 'checksum' in info and relative_path not in exclude
+    }
+    try:
+        cache_path = _state_cache_path(root)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        # ensure_ascii escapes the lone surrogates that undecodable file names carry.
+        with open(tmp_path, 'w', encoding='ascii') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+def _checksum_worker(job):
+    """Process pool entry point; returns the job's key alongside the checksum."""
+    file_path, key, hash_algorithm, size, mtime_ns, use_cache, update_cache = job
+    try:
+        return key, get_checksum(file_path, hash_algorithm, size, mtime_ns, use_cache, update_cache)
+    except Exception:
+        return key, None
+
+def _prefetch(paths):
+    """Asks the kernel to start reading the start of each file in the background."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, PREFETCH_SIZE, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def _checksum_batch_worker(jobs):
+    """Process pool entry point for a batch of files.
+
+    Readahead for the whole batch is requested up front, so the kernel can
+    fetch the files concurrently while the earlier ones are being hashed.
+    """
+    _prefetch(
+        file_path for file_path, _, hash_algorithm, size, mtime_ns, use_cache, _ in jobs
+        if size <= TREE_HASH_SIZE
+        and (not use_cache or _read_cached_checksum(file_path, hash_algorithm, size, mtime_ns) is None)
+    )
+    return [_checksum_worker(job) for job in jobs]
+
+def _start_walk(executor, path, found, side, max_workers=None):
+    """Scans the tree under path on the executor's threads.
+
+    Puts (side, files) on found for each directory with files in it, where
+    files is a list of (relative path, size, mtime_ns, inode, device) records,
+    and (side, None) once the whole tree is done. Many directories are scanned
+    at once so that slow listings (spinning disks, network mounts) overlap.
+    Pending directories are ordered by inode number to roughly follow on-disk
+    layout.
+
+    If the native extension is installed, it scans the tree instead, on
+    its own threads, putting files on found the same way. If the scan
+    fails, the exception is put on found in place of the files, so the
+    side is never taken to be empty.
+    """
+    if scan_tree is not None:
+        def native_scan():
             try:
-                info = future.result()
-                if info:
-                    state[relative_path] = info
-            except Exception:
-                pass
-                
-    return state
+                scan_tree(path, max_workers or os.cpu_count() or 1, lambda files: found.put((side, files)))
+            except Exception as e:
+                found.put((side, e))
+                return
+            found.put((side, None))
+
+        executor.submit(native_scan)
+        return
+
+    # Every scanned path starts with the root plus a separator, so relative
+    # paths are a slice away; os.path.relpath is far slower per file.
+    prefix_length = len(os.path.join(path, ''))
+    directories = queue.PriorityQueue()
+    lock = threading.Lock()
+    # Directories that are queued or currently being scanned.
+    pending = [1]
+
+    def scan():
+        # Each task scans one directory: whichever pending one has the lowest inode.
+        _, directory = directories.get()
+        files = []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            with lock:
+                                pending[0] += 1
+                            directories.put((entry.inode(), entry.path))
+                            executor.submit(scan)
+                        elif entry.is_file():
+                            # Symlinked directories are skipped, as os.walk did;
+                            # symlinked files are followed like the copy does.
+                            # Pipes, sockets and devices are skipped: opening a
+                            # pipe to hash or copy it blocks.
+                            st = entry.stat()
+                            files.append((entry.path[prefix_length:], st.st_size, st.st_mtime_ns,
+                                          st.st_ino, st.st_dev))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        finally:
+            if files:
+                found.put((side, files))
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                found.put((side, None))
+
+    directories.put((0, path))
+    executor.submit(scan)
+
+def _init_hash_worker(threads):
+    """Hashing pool initializer: caps the threads of each BLAKE3 tree hash."""
+    global _blake3_threads
+    _blake3_threads = threads
+
+def _hash_worker_threads(max_workers):
+    """Returns how many BLAKE3 threads each of max_workers hashing processes gets."""
+    cpus = os.cpu_count() or 1
+    return max(1, cpus // (max_workers or cpus))
+
+def _hash_process_context():
+    """Returns the multiprocessing context for the hashing pool.
+
+    The pool starts while scanner threads are running, and forking a
+    multi-threaded process can deadlock the child, so fork is never used.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def get_directory_states(src_path, dest_path, compare_mode, executor, hash_algorithm='xxh3', max_workers=None,
+                         use_cache=True, update_cache=True):
+    """Scans the source and destination together on a thread pool and returns both states.
+
+    In checksum mode a path is sent for hashing as soon as both sides have
+    been seen with equal sizes; a size difference already decides the
+    outcome. Entries whose file could not be hashed are dropped. Checksums
+    are carried over from the previous run's state cache while the file's
+    mtime and size are unchanged. With update_cache off (dry runs), no
+    checksum xattrs are written. The state cache itself is saved by the
+    caller, which knows which paths are about to change.
+    """
+    roots = (src_path, dest_path)
+    states = ({}, {})
+    caches = ({}, {})
+    if compare_mode == 'checksum' and use_cache:
+        caches = tuple(load_state_cache(root) for root in roots)
+    found = queue.Queue()
+    for side in (0, 1):
+        _start_walk(executor, roots[side], found, side, max_workers)
+
+    # Hashing is CPU-bound, so use processes to get around the GIL.
+    hash_executor = None
+    if compare_mode == 'checksum':
+        hash_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=_hash_process_context(),
+            initializer=_init_hash_worker, initargs=(_hash_worker_threads(max_workers),))
+    futures = []
+    batch = []
+    try:
+        running = 2
+        while running:
+            side, files = found.get()
+            if isinstance(files, Exception):
+                raise files
+            if files is None:
+                running -= 1
+                continue
+            state, other_state = states[side], states[1 - side]
+            for relative_path, size, mtime_ns, ino, dev in files:
+                state[relative_path] = {'size': size, 'mtime_ns': mtime_ns, 'ino': ino, 'dev': dev}
+                other = other_state.get(relative_path)
+                if hash_executor is None or other is None or other['size'] != size:
+                    continue
+                if is_same_file(state[relative_path], other):
+                    # Hard links to the same inode; nothing to hash.
+                    continue
+                for i in (0, 1):
+                    info = states[i][relative_path]
+                    cached = caches[i].get(relative_path)
+                    if (cached is not None and cached[:2] == (info['mtime_ns'], info['size'])
+                            and cached[2].startswith(_effective_algorithm(hash_algorithm, size) + ':')):
+                        info['checksum'] = cached[2]
+                        continue
+                    batch.append((os.path.join(roots[i], relative_path), (i, relative_path),
+                                  hash_algorithm, info['size'], info['mtime_ns'], use_cache, update_cache))
+                if len(batch) >= HASH_BATCH_SIZE:
+                    futures.append(hash_executor.submit(_checksum_batch_worker, batch))
+                    batch = []
+        if batch:
+            futures.append(hash_executor.submit(_checksum_batch_worker, batch))
+
+        for future in concurrent.futures.as_completed(futures):
+            for (i, relative_path), checksum in future.result():
+                if checksum is None:
+                    del states[i][relative_path]
+                else:
+                    states[i][relative_path]['checksum'] = checksum
+    finally:
+        if hash_executor is not None:
+            hash_executor.shutdown()
+    return states
+
+def is_same_file(info, other_info):
+    """Checks whether two state entries refer to the same inode.
+
+    An inode number of 0 means the platform didn't report one (DirEntry.stat
+    on Windows), which says nothing about the file.
+    """
+    return info['ino'] != 0 and info['dev'] == other_info['dev'] and info['ino'] == other_info['ino']
 
 def compare_states(src_state, dest_state, compare_mode):
     """Compares two directory states and returns the necessary changes."""
@@ -64,7 +472,9 @@ def compare_states(src_state, dest_state, compare_mode):
         dest_info = dest_state.get(path)
         if not dest_info:
             changes['to_copy'].append(path)
-        elif compare_mode == 'size' and src_info['size'] != dest_info['size']:
+        elif is_same_file(src_info, dest_info):
+            continue
+        elif src_info['size'] != dest_info['size']:
             changes['to_replace'].append(path)
         elif compare_mode == 'checksum' and src_info.get('checksum') != dest_info.get('checksum'):
             changes['to_replace'].append(path)
@@ -84,41 +494,103 @@ def print_change_report(changes, dest_path):
 
     print(f"{dest_path}/")
 
-    all_paths = sorted(list(set(p for v in changes.values() for p in v)))
-    tree = defaultdict(list)
+    # The three lists are disjoint, and print_tree sorts each level itself.
+    all_paths = chain(changes['to_copy'], changes['to_replace'], changes['to_delete'])
+    # Trie of path components: each node maps a name to its children.
+    tree = {}
     for path in all_paths:
-        parts = path.split(os.sep)
-        for i in range(len(parts)):
-            parent = os.path.join(*parts[:i]) if i > 0 else '.'
-            if parent not in tree:
-                tree[parent] = []
-            if parts[i] not in tree[parent]:
-                tree[parent].append(parts[i])
+        node = tree
+        for part in path.split(os.sep):
+            node = node.setdefault(part, {})
+
+    copy_set = frozenset(changes['to_copy'])
+    replace_set = frozenset(changes['to_replace'])
+    delete_set = frozenset(changes['to_delete'])
 
     def get_change_marker(path):
-        if path in changes['to_copy']:
+        if path in copy_set:
             return '[+]'
-        if path in changes['to_replace']:
+        if path in replace_set:
             return '[~]'
-        if path in changes['to_delete']:
+        if path in delete_set:
             return '[-]'
         return '   '
 
-    def print_tree(directory, prefix=""):
-        entries = sorted(tree.get(directory, []))
+    def print_tree(node, directory='', prefix=""):
+        entries = sorted(node)
         for i, entry in enumerate(entries):
             is_last = i == len(entries) - 1
             connector = "└── " if is_last else "├── "
-            path = os.path.join(directory, entry) if directory != '.' else entry
+            path = os.path.join(directory, entry) if directory else entry
             marker = get_change_marker(path)
             print(f"{prefix}{connector}{marker} {entry}")
-            if path in tree:
+            if node[entry]:
                 new_prefix = prefix + ("    " if is_last else "│   ")
-                print_tree(path, new_prefix)
+                print_tree(node[entry], path, new_prefix)
+
+    print_tree(tree)
+
+# Errors meaning the kernel copy path is unsupported here, not that the copy failed.
+_COPY_FALLBACK_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP}
 
-    print_tree('.')
+def _kernel_copy(in_fd, out_fd):
+    """Copies the rest of in_fd to out_fd without going through user space.
 
-def execute_change(change_type, path, src_root, dest_root, quiet=False):
+    Returns False if neither copy_file_range nor sendfile works here. A call
+    that copies nothing from a file that isn't empty counts as not working:
+    some filesystems (FUSE, procfs-like ones, some cross-filesystem copies)
+    report 0 bytes instead of failing. Both advance the file offsets, so a
+    fallback carries on where they stopped.
+    """
+    size = os.fstat(in_fd).st_size
+    copiers = []
+    if hasattr(os, 'copy_file_range'):
+        # Can reflink on filesystems like Btrfs and XFS.
+        copiers.append(lambda: os.copy_file_range(in_fd, out_fd, 1 << 30))
+    if hasattr(os, 'sendfile'):
+        copiers.append(lambda: os.sendfile(out_fd, in_fd, None, 1 << 30))
+    for copy_chunk in copiers:
+        copied = 0
+        try:
+            n = copy_chunk()
+            while n > 0:
+                copied += n
+                n = copy_chunk()
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+            continue
+        if copied or size == 0:
+            return True
+    return False
+
+def _fast_copy(src_path, dest_path):
+    """Copies a file and its metadata like shutil.copy2, keeping the data in the kernel where possible."""
+    # Checked before opening, as shutil.copyfile does: opening a pipe blocks.
+    if not stat.S_ISREG(os.stat(src_path).st_mode):
+        raise shutil.SpecialFileError(f"'{src_path}' is not a regular file")
+    with open(src_path, 'rb') as fsrc, open(dest_path, 'wb') as fdst:
+        if not _kernel_copy(fsrc.fileno(), fdst.fileno()):
+            shutil.copyfileobj(fsrc, fdst, length=CHUNK_SIZE)
+    # The destination was rewritten in place, so a checksum cached on it
+    # describes the old content; copystat is about to give it the source's
+    # mtime and size, which would make that checksum look valid.
+    _clear_cached_checksum(dest_path)
+    shutil.copystat(src_path, dest_path)
+
+def _link_into_place(src_path, dest_path):
+    """Atomically replaces dest_path with a hard link to src_path."""
+    tmp_path = f"{dest_path}.directory_sync.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.link(src_path, tmp_path)
+    try:
+        os.replace(tmp_path, dest_path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+def execute_change(change_type, path, src_root, dest_root, quiet=False, hard_link=False):
     """Executes the actual file operation. Can be called from a thread."""
     src_path = os.path.join(src_root, path)
     dest_path = os.path.join(dest_root, path)
@@ -126,7 +598,16 @@ def execute_change(change_type, path, src_root, dest_root, quiet=False):
     try:
         if change_type == 'copy' or change_type == 'replace':
             os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-            shutil.copy2(src_path, dest_path)
+            if hard_link:
+                try:
+                    _link_into_place(src_path, dest_path)
+                    if not quiet:
+                        print(f"Linked '{path}'")
+                    return
+                except OSError:
+                    # Different filesystems, or links not supported; copy instead.
+                    pass
+            _fast_copy(src_path, dest_path)
             if not quiet:
                 print(f"Copied/Replaced '{path}'")
         elif change_type == 'delete':
@@ -143,8 +624,14 @@ def main():
     parser.add_argument('--dest', required=True, help="Destination directory path.")
     parser.add_argument('--compare_mode', choices=['size', 'checksum'], default='size',
                         help="Comparison mode: size or checksum.")
+    parser.add_argument('--hash', choices=HASH_ALGORITHMS, default='xxh3',
+                        help="Hash algorithm used in checksum mode.")
+    parser.add_argument('--no_checksum_cache', action='store_true',
+                        help="Don't read or write cached checksums (extended attributes and the state cache).")
+    parser.add_argument('--hard_link', action='store_true',
+                        help="Hard link files into the destination instead of copying when on the same filesystem.")
     parser.add_argument('--dry_run', action='store_true', help="Only print changes, don't execute them.")
-    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="Number of worker threads.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="Number of parallel workers.")
     args = parser.parse_args()
 
     if not os.path.isdir(args.src):
@@ -154,10 +641,21 @@ def main():
         print(f"Destination directory not found: {args.dest}")
         return
 
+    if args.compare_mode == 'checksum' and args.hash == 'blake3' and blake3 is None:
+        print("The 'blake3' package is required for --hash blake3.")
+        return
+
+    # One thread pool serves scanning and the trusted copy phase.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        synchronize(args, executor)
+
+def synchronize(args, executor):
+    """Scans both directories, reports the changes and applies them."""
     print("Analyzing directories...")
     # Parallel scanning
-    src_state = get_directory_state(args.src, args.compare_mode, args.workers)
-    dest_state = get_directory_state(args.dest, args.compare_mode, args.workers)
+    src_state, dest_state = get_directory_states(
+        args.src, args.dest, args.compare_mode, executor, args.hash, args.workers,
+        use_cache=not args.no_checksum_cache, update_cache=not args.dry_run)
     print(f"Scanned {len(src_state)} files in source and {len(dest_state)} files in destination.")
 
     changes = compare_states(src_state, dest_state, args.compare_mode)
@@ -168,6 +666,12 @@ def main():
         print("\n--- Dry run complete. No changes were made. ---")
         return
 
+    if args.compare_mode == 'checksum' and not args.no_checksum_cache:
+        # Saved before anything is touched; destination paths about to be
+        # written or deleted are left out, as their cached digest goes stale.
+        save_state_cache(args.src, src_state)
+        save_state_cache(args.dest, dest_state, exclude=frozenset(chain(*changes.values())))
+
     if not any(changes.values()):
         return
 
@@ -197,7 +701,7 @@ def main():
 
         if response == 'y':
             try:
-                execute_change(change_type, path, args.src, args.dest)
+                execute_change(change_type, path, args.src, args.dest, hard_link=args.hard_link)
             except Exception as e:
                 print(e)
         
@@ -210,17 +714,16 @@ def main():
             # Collect remaining tasks
             remaining_tasks = [(change_type, path)] + list(tasks_iter)
             
-            with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-                future_to_task = {
-                    executor.submit(execute_change, c_type, p, args.src, args.dest, quiet=True): (c_type, p)
-                    for c_type, p in remaining_tasks
-                }
-                
-                for future in tqdm(concurrent.futures.as_completed(future_to_task), total=len(remaining_tasks), desc="Synchronizing"):
-                    try:
-                        future.result()
-                    except Exception as exc:
-                        tqdm.write(str(exc))
+            future_to_task = {
+                executor.submit(execute_change, c_type, p, args.src, args.dest, quiet=True, hard_link=args.hard_link): (c_type, p)
+                for c_type, p in remaining_tasks
+            }
+            
+            for future in tqdm(concurrent.futures.as_completed(future_to_task), total=len(remaining_tasks), desc="Synchronizing"):
+                try:
+                    future.result()
+                except Exception as exc:
+                    tqdm.write(str(exc))
             
             # All done
             break
@@ -4,15 +4,26 @@ import random
 import string
 import shutil
 
+# Maps every byte value onto a lowercase letter.
+_ALPHABET_TABLE = bytes(ord(string.ascii_lowercase[i % 26]) for i in range(256))
+
+def random_letters(length):
+    """Generate random lowercase ASCII letters as bytes."""
+    if hasattr(random, 'randbytes'):
+        data = random.randbytes(length)
+    else:
+        # random.randbytes is new in Python 3.9.
+        data = random.getrandbits(8 * length).to_bytes(length, 'little') if length else b''
+    return data.translate(_ALPHABET_TABLE)
+
 def generate_random_string(length):
     """Generate a random string of fixed length."""
-    letters = string.ascii_lowercase
-    return ''.join(random.choice(letters) for i in range(length))
+    return random_letters(length).decode('ascii')
 
 def create_random_file(path, size):
     """Create a file with random content."""
-    with open(path, 'w') as f:
-        f.write(generate_random_string(size))
+    with open(path, 'wb') as f:
+        f.write(random_letters(size))
 
 def create_dir_structure(base_dir, max_depth, current_depth, all_dirs):
     """Recursively create a directory structure."""
@@ -0,0 +1,386 @@
+import argparse
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import io
+import os
+import queue
+import tempfile
+import unittest
+from unittest import mock
+
+import xxhash
+
+from directory_sync import main
+from directory_sync.main import (
+    CHECKSUM_XATTR, OVERLAPPED_READ_SIZE, SMALL_FILE_SIZE, _fast_copy, _hash_worker_threads,
+    _init_hash_worker, _link_into_place, _start_walk, _state_cache_path, compare_states, execute_change,
+    get_directory_states, hash_file, load_state_cache, new_hasher, print_change_report, save_state_cache,
+    synchronize,
+)
+
+try:
+    from directory_sync_native import scan_tree
+except ImportError:
+    scan_tree = None
+
+
+def _info(size, checksum=None, ino=0, dev=0):
+    info = {'size': size, 'mtime_ns': 0, 'ino': ino, 'dev': dev}
+    if checksum is not None:
+        info['checksum'] = checksum
+    return info
+
+
+class CompareStatesTest(unittest.TestCase):
+    def test_replaces_when_inode_numbers_are_unknown(self):
+        # DirEntry.stat() reports st_ino and st_dev as 0 on Windows.
+        src_state = {'a': _info(4), 'b': _info(4, 'xxh3:1')}
+        dest_state = {'a': _info(5), 'b': _info(4, 'xxh3:2')}
+        self.assertEqual(compare_states(src_state, dest_state, 'size')['to_replace'], ['a'])
+        self.assertEqual(sorted(compare_states(src_state, dest_state, 'checksum')['to_replace']), ['a', 'b'])
+
+    def test_skips_hard_links_to_the_same_inode(self):
+        src_state = {'a': _info(4, 'xxh3:1', ino=7, dev=1)}
+        dest_state = {'a': _info(4, 'xxh3:2', ino=7, dev=1)}
+        self.assertEqual(compare_states(src_state, dest_state, 'checksum')['to_replace'], [])
+
+
+class ChangeReportTest(unittest.TestCase):
+    """The trie-based report must print exactly what the original tree builder printed."""
+
+    def report(self, changes):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            print_change_report(changes, '/dest')
+        return out.getvalue()
+
+    def test_matches_the_original_tree_format(self):
+        changes = {
+            'to_copy': ['a/new.txt', 'z', 'a/b/c/deep', 'top'],
+            'to_replace': ['a/b/changed', 'm/x'],
+            'to_delete': ['a/gone', 'm/y/old', 'd'],
+        }
+        # Output of the original print_change_report for the same changes.
+        self.assertEqual(self.report(changes), """
+--- Synchronization Plan ---
+/dest/
+├──     a
+│   ├──     b
+│   │   ├──     c
+│   │   │   └── [+] deep
+│   │   └── [~] changed
+│   ├── [-] gone
+│   └── [+] new.txt
+├── [-] d
+├──     m
+│   ├── [~] x
+│   └──     y
+│       └── [-] old
+├── [+] top
+└── [+] z
+""")
+
+    def test_reports_directories_in_sync(self):
+        self.assertEqual(self.report({'to_copy': [], 'to_delete': [], 'to_replace': []}),
+                         "\n--- Synchronization Plan ---\nDirectories are already in sync.\n")
+
+
+class HashFileTest(unittest.TestCase):
+    def test_hashes_raw_bytes_for_every_read_strategy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for size in (0, SMALL_FILE_SIZE, SMALL_FILE_SIZE + 1, OVERLAPPED_READ_SIZE + 1):
+                # CRLF and Ctrl-Z would be mangled by a text-mode read on Windows.
+                data = (b'ab\r\n\x1acd' * (size // 7 + 1))[:size]
+                path = os.path.join(tmp, str(size))
+                with open(path, 'wb') as f:
+                    f.write(data)
+                hasher = hashlib.md5()
+                hash_file(path, hasher)
+                self.assertEqual(hasher.hexdigest(), hashlib.md5(data).hexdigest(), size)
+
+
+class Blake3ThreadsTest(unittest.TestCase):
+    def test_pool_shares_the_cores(self):
+        with mock.patch('os.cpu_count', return_value=8):
+            self.assertEqual(_hash_worker_threads(None), 1)
+            self.assertEqual(_hash_worker_threads(8), 1)
+            self.assertEqual(_hash_worker_threads(16), 1)
+            self.assertEqual(_hash_worker_threads(2), 4)
+
+    def test_hashers_use_the_worker_limit(self):
+        self.addCleanup(_init_hash_worker, main._blake3_threads)
+        _init_hash_worker(3)
+        with mock.patch.object(main, 'blake3') as blake3:
+            new_hasher('blake3')
+        blake3.blake3.assert_called_once_with(max_threads=3)
+
+
+class ChecksumCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': os.path.join(self.tmp.name, 'cache')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        for root, content in ((self.src, b'AAAA'), (self.dest, b'BBBB')):
+            os.makedirs(root)
+            with open(os.path.join(root, 'f'), 'wb') as f:
+                f.write(content)
+            os.utime(os.path.join(root, 'f'), ns=(1_000_000_000, 1_000_000_000))
+
+    def scan(self, **kwargs):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            return get_directory_states(self.src, self.dest, 'checksum', executor, max_workers=1, **kwargs)
+
+    @unittest.skipUnless(hasattr(os, 'listxattr'), "needs extended attributes")
+    def test_dry_run_writes_no_xattrs(self):
+        self.scan(update_cache=False)
+        for root in (self.src, self.dest):
+            self.assertNotIn(CHECKSUM_XATTR, os.listxattr(os.path.join(root, 'f')))
+
+    @unittest.skipUnless(hasattr(os, 'setxattr'), "needs extended attributes")
+    def test_replace_drops_stale_checksum_xattr(self):
+        # A destination checksum from an earlier run, on a source that can't hold xattrs.
+        dest_file = os.path.join(self.dest, 'f')
+        try:
+            os.setxattr(dest_file, CHECKSUM_XATTR, f"1000000000:4:xxh3:{xxhash.xxh3_128(b'BBBB').hexdigest()}".encode())
+        except OSError:
+            self.skipTest("filesystem has no extended attributes")
+        execute_change('replace', 'f', self.src, self.dest, quiet=True)
+        self.assertNotIn(CHECKSUM_XATTR, os.listxattr(dest_file))
+        self.assertEqual(compare_states(*self.scan(), 'checksum')['to_replace'], [])
+
+    def sync(self, dry_run=False, answer='y', hard_link=False):
+        args = argparse.Namespace(
+            src=self.src, dest=self.dest, compare_mode='checksum', hash='xxh3', no_checksum_cache=False,
+            hard_link=hard_link, dry_run=dry_run, workers=2,
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor, \
+                mock.patch('builtins.input', return_value=answer), \
+                contextlib.redirect_stdout(io.StringIO()):
+            synchronize(args, executor)
+
+    def test_failed_native_scan_is_raised(self):
+        # An empty source would plan every destination file for deletion.
+        with mock.patch('directory_sync.main.scan_tree', side_effect=RuntimeError("directory scan failed")):
+            with self.assertRaisesRegex(RuntimeError, "directory scan failed"):
+                self.scan()
+
+    def test_state_cache_round_trips(self):
+        name = os.fsdecode(b'caf\xe9')
+        save_state_cache(self.src, {name: {'size': 4, 'mtime_ns': 5, 'checksum': 'xxh3:ab'}, 'g': {'size': 1}})
+        self.assertEqual(load_state_cache(self.src), {name: (5, 4, 'xxh3:ab')})
+
+    def test_malformed_state_cache_is_ignored(self):
+        cache_path = _state_cache_path(self.src)
+        os.makedirs(os.path.dirname(cache_path))
+        for content in (b'\x80\x04K\x01.', b'[1, 2]',
+                        b'{"f": [1000000000, 4], "g": ["1", 2, "x"], "h": [1, 2, 3], "i": 7}'):
+            with open(cache_path, 'wb') as f:
+                f.write(content)
+            self.assertEqual(load_state_cache(self.src), {})
+            src_state, _ = self.scan()
+            self.assertTrue(src_state['f']['checksum'].startswith('xxh3:'))
+
+    def test_dry_run_writes_no_state_cache(self):
+        self.sync(dry_run=True)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'cache')))
+
+    def test_synced_file_is_not_reported_again(self):
+        # Same size and mtime, different content: only the checksum tells them apart.
+        self.assertEqual(compare_states(*self.scan(), 'checksum')['to_replace'], ['f'])
+        self.sync()
+        with open(os.path.join(self.dest, 'f'), 'rb') as f:
+            self.assertEqual(f.read(), b'AAAA')
+        self.assertEqual(compare_states(*self.scan(), 'checksum')['to_replace'], [])
+
+    def test_hard_link_replaces_and_copies_with_links(self):
+        with open(os.path.join(self.src, 'g'), 'wb') as f:
+            f.write(b'new')
+        self.sync(hard_link=True)
+        for name in ('f', 'g'):
+            self.assertTrue(os.path.samefile(os.path.join(self.src, name), os.path.join(self.dest, name)))
+        self.assertEqual(sorted(os.listdir(self.dest)), ['f', 'g'])
+        self.assertEqual(compare_states(*self.scan(), 'checksum'), {'to_copy': [], 'to_delete': [], 'to_replace': []})
+
+    def test_hard_link_falls_back_to_copying_across_filesystems(self):
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, os.strerror(errno.EXDEV))):
+            self.sync(hard_link=True)
+        dest_file = os.path.join(self.dest, 'f')
+        self.assertFalse(os.path.samefile(os.path.join(self.src, 'f'), dest_file))
+        with open(dest_file, 'rb') as f:
+            self.assertEqual(f.read(), b'AAAA')
+
+    def test_failed_link_leaves_the_destination_alone(self):
+        src_file, dest_file = os.path.join(self.src, 'f'), os.path.join(self.dest, 'f')
+        # A temporary link left behind by an interrupted run is cleared first.
+        with open(f"{dest_file}.directory_sync.tmp", 'wb'):
+            pass
+        with mock.patch('os.replace', side_effect=OSError(errno.EACCES, os.strerror(errno.EACCES))):
+            with self.assertRaises(OSError):
+                _link_into_place(src_file, dest_file)
+        self.assertEqual(os.listdir(self.dest), ['f'])
+        with open(dest_file, 'rb') as f:
+            self.assertEqual(f.read(), b'BBBB')
+        _link_into_place(src_file, dest_file)
+        self.assertTrue(os.path.samefile(src_file, dest_file))
+        self.assertEqual(os.listdir(self.dest), ['f'])
+
+
+class FastCopyTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, 'src')
+        self.dest = os.path.join(tmp.name, 'dest')
+        self.data = bytes(range(256)) * 1024 + b'tail'
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        os.utime(self.src, ns=(1_000_000_000, 2_000_000_000))
+
+    def assertCopied(self):
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.stat(self.dest).st_mtime_ns, 2_000_000_000)
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range') or hasattr(os, 'sendfile'), "needs a kernel copy call")
+    def test_copies_in_the_kernel(self):
+        with mock.patch('shutil.copyfileobj', side_effect=AssertionError("copied in user space")):
+            _fast_copy(self.src, self.dest)
+        self.assertCopied()
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), "needs sendfile")
+    def test_falls_back_to_sendfile_when_copy_file_range_fails(self):
+        error = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        with mock.patch('os.copy_file_range', side_effect=error, create=True), \
+                mock.patch('shutil.copyfileobj', side_effect=AssertionError("copied in user space")):
+            _fast_copy(self.src, self.dest)
+        self.assertCopied()
+
+    def test_falls_back_when_kernel_copies_report_nothing(self):
+        # copy_file_range answers 0 on some filesystems for files that aren't empty.
+        with mock.patch('os.copy_file_range', return_value=0, create=True), \
+                mock.patch('os.sendfile', return_value=0, create=True):
+            _fast_copy(self.src, self.dest)
+        self.assertCopied()
+
+    def test_copies_empty_files(self):
+        self.data = b''
+        with open(self.src, 'wb'):
+            pass
+        os.utime(self.src, ns=(1_000_000_000, 2_000_000_000))
+        _fast_copy(self.src, self.dest)
+        self.assertCopied()
+
+
+@unittest.skipUnless(hasattr(os, 'mkfifo'), "needs named pipes")
+class SpecialFileTest(unittest.TestCase):
+    """Opening a named pipe blocks until a writer shows up, so pipes must never be opened."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, 'src')
+        self.dest = os.path.join(tmp.name, 'dest')
+        os.makedirs(self.src)
+        os.makedirs(self.dest)
+        os.mkfifo(os.path.join(self.src, 'pipe'))
+        with open(os.path.join(self.src, 'f'), 'wb') as f:
+            f.write(b'data')
+
+    def test_scan_skips_pipes(self):
+        with mock.patch('directory_sync.main.scan_tree', None), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            src_state, _ = get_directory_states(self.src, self.dest, 'checksum', executor, max_workers=1,
+                                                use_cache=False)
+        self.assertEqual(list(src_state), ['f'])
+
+    def test_copying_a_pipe_fails(self):
+        with self.assertRaisesRegex(Exception, "Error during copy of 'pipe'"):
+            execute_change('copy', 'pipe', self.src, self.dest, quiet=True)
+        self.assertFalse(os.path.lexists(os.path.join(self.dest, 'pipe')))
+
+
+@unittest.skipIf(scan_tree is None, "native scanner not installed")
+class NativeScannerTest(unittest.TestCase):
+    """The native scanner must return exactly the Python walker's records."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.tree = os.path.join(self.tmp, 'tree')
+        for directory in ('a/b/c', 'a/empty', 'd'):
+            os.makedirs(os.path.join(self.tree, directory))
+        for name, data in (('top', b'1'), ('a/f', b'22'), ('a/b/c/g', b'333'), ('d/h', b''),
+                           (os.fsdecode(b'd/caf\xe9'), b'4444')):
+            with open(os.path.join(self.tree, name), 'wb') as f:
+                f.write(data)
+        os.link(os.path.join(self.tree, 'top'), os.path.join(self.tree, 'd/hard'))
+        os.symlink('top', os.path.join(self.tree, 'file_link'))
+        os.symlink('a', os.path.join(self.tree, 'dir_link'))
+        os.symlink('missing', os.path.join(self.tree, 'broken_link'))
+        if hasattr(os, 'mkfifo'):
+            os.mkfifo(os.path.join(self.tree, 'a/fifo'))
+
+    def python_walk(self, path):
+        found = queue.Queue()
+        with mock.patch('directory_sync.main.scan_tree', None), \
+                concurrent.futures.ThreadPoolExecutor(4) as executor:
+            _start_walk(executor, path, found, 'src')
+            records = []
+            while True:
+                _, files = found.get()
+                if files is None:
+                    return sorted(records)
+                records.extend(files)
+
+    def native_walk(self, path, threads):
+        batches = []
+        scan_tree(path, threads, batches.append)
+        return sorted(record for batch in batches for record in batch)
+
+    def assertSameRecords(self, path):
+        expected = self.python_walk(path)
+        for threads in (1, 4):
+            with self.subTest(path=path, threads=threads):
+                self.assertEqual(self.native_walk(path, threads), expected)
+        return expected
+
+    def test_matches_python_walker(self):
+        records = self.assertSameRecords(self.tree)
+        self.assertIn('a/b/c/g', [record[0] for record in records])
+        self.assertNotIn('dir_link/f', [record[0] for record in records])
+        self.assertNotIn('a/fifo', [record[0] for record in records])
+
+    def test_matches_python_walker_for_other_roots(self):
+        root_link = os.path.join(self.tmp, 'root_link')
+        os.symlink(self.tree, root_link)
+        self.assertTrue(self.assertSameRecords(root_link))
+        self.assertSameRecords(os.path.join(self.tree, ''))
+        self.assertSameRecords(os.path.join(self.tree, 'a', 'empty'))
+        self.assertSameRecords(os.path.join(self.tmp, 'missing'))
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp)
+        self.assertSameRecords('tree')
+
+    def test_files_arrive_one_directory_at_a_time(self):
+        batches = []
+        scan_tree(self.tree, 2, batches.append)
+        directories = [{os.path.dirname(record[0]) for record in batch} for batch in batches]
+        self.assertEqual(sorted(d for (d,) in directories), ['', 'a', 'a/b/c', 'd'])
+
+    def test_callback_errors_stop_the_scan(self):
+        def fail(files):
+            raise KeyError('stop')
+
+        with self.assertRaises(KeyError):
+            scan_tree(self.tree, 4, fail)
+
+
+if __name__ == '__main__':
+    unittest.main()